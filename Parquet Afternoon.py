@@ -1,29 +1,64 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-from fpdf import FPDF
+import numexpr as ne
+import pyarrow.parquet as pq
+from matplotlib.figure import Figure
 import tempfile
 import requests
 import os
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
 # ---------------------- CONFIGURATION ----------------------
 st.set_page_config(layout="wide")
 st.title("📊 Expectancy Change Viewer")
 
+EXP_COLS = [
+    'GOALS_EXP_HOME', 'GOALS_EXP_AWAY',
+    'CORNERS_EXP_HOME', 'CORNERS_EXP_AWAY',
+    'YELLOW_EXP_HOME', 'YELLOW_EXP_AWAY'
+]
+
+# Only these columns are decoded from the Parquet file
+NEEDED_COLS = ['SRC_EVENT_ID', 'MINUTES', 'EVENT_START_TIMESTAMP'] + EXP_COLS
+
 # ---------------------- FILE LOADING ----------------------
-@st.cache_data(show_spinner=True)
+# Cached as a shared resource: the frame is read-only after loading, so it is
+# handed out by reference instead of being pickled and copied on every rerun
+@st.cache_resource(show_spinner=True)
 def load_parquet_from_gdrive(url):
     file_id = url.split("/d/")[-1].split("/")[0]
     download_url = f"https://drive.google.com/uc?id={file_id}"
-    response = requests.get(download_url)
-    response.raise_for_status()
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".parquet") as tmp_file:
-        tmp_file.write(response.content)
-        tmp_path = tmp_file.name
-    df = pd.read_parquet(tmp_path)
-    os.remove(tmp_path)
+    # Keep the download on disk so app restarts don't fetch it again
+    cache_path = os.path.join(tempfile.gettempdir(), f"gdrive_{file_id}.parquet")
+    if not os.path.exists(cache_path):
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".parquet", dir=os.path.dirname(cache_path)) as tmp_file:
+            tmp_path = tmp_file.name
+        try:
+            with requests.get(download_url, stream=True) as response, open(tmp_path, "wb") as out_file:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    out_file.write(chunk)
+            # Drive can answer 200 with an HTML warning page; only cache real Parquet
+            pq.ParquetFile(tmp_path).close()
+            os.replace(tmp_path, cache_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+    columns = [c for c in NEEDED_COLS if c in pq.read_schema(cache_path).names]
+    table = pq.read_table(cache_path, columns=columns, use_threads=True)
+    df = table.to_pandas(self_destruct=True)
+    # Rows without a minute can't be banded; dropping them lets MINUTES be int16
+    df = df.dropna(subset=['MINUTES'])
+    df['MINUTES'] = df['MINUTES'].astype(np.int16)
+    exp_cols = [c for c in EXP_COLS if c in df.columns]
+    df[exp_cols] = df[exp_cols].astype(np.float32)
+    # Categorical ids let the sort, dedupe and join work on integer codes
+    df['SRC_EVENT_ID'] = df['SRC_EVENT_ID'].astype('category')
+    if 'EVENT_START_TIMESTAMP' in df.columns:
+        df['EVENT_START_TIMESTAMP'] = pd.to_datetime(df['EVENT_START_TIMESTAMP'], errors='coerce', dayfirst=True)
     return df
 
 st.markdown("<sub>*Favourites are determined using Goal Expectancy at the earliest available minute in each match</sub>", unsafe_allow_html=True)
@@ -36,9 +71,8 @@ with st.spinner("🔄 Loading Parquet file..."):
     st.success("✅ File downloaded successfully.")
     st.success(f"✅ Parquet loaded: {df.shape[0]:,} rows")
 
-# Date parsing
+# Date parsing happens inside the cached loader
 if 'EVENT_START_TIMESTAMP' in df.columns:
-    df['EVENT_START_TIMESTAMP'] = pd.to_datetime(df['EVENT_START_TIMESTAMP'], errors='coerce', dayfirst=True)
     st.success("🗓️ Datetime parsing completed.")
 
 # ---------------------- EXPECTANCY OPTIONS ----------------------
@@ -56,87 +90,116 @@ fav_levels = st.sidebar.multiselect("Goal Favouritism Level", ["Strong Favourite
 scoreline_filter = st.sidebar.multiselect("Goal Scoreline Filter", ["Favourite Winning", "Scores Level", "Underdog Winning"])
 
 # ---------------------- PROCESSING ----------------------
-@st.cache_data(show_spinner=True)
+@st.cache_resource(show_spinner=True)
+def sort_by_event(df):
+    # Files written by sort_parquet.py are already in order; checking that is a linear pass
+    event_steps = np.diff(df['SRC_EVENT_ID'].cat.codes.to_numpy())
+    minute_steps = np.diff(df['MINUTES'].to_numpy())
+    if ((event_steps > 0) | ((event_steps == 0) & (minute_steps >= 0))).all():
+        return df
+    return df.sort_values(['SRC_EVENT_ID', 'MINUTES'], ignore_index=True)
+
+@st.cache_resource(show_spinner=True)
+def flag_favourites(df):
+    # df is sorted by sort_by_event; each match's favourite is fixed by Goal Expectancy
+    # at its earliest minute and broadcast to every row for all expectancy types
+    goals_base = df.dropna(subset=['GOALS_EXP_HOME', 'GOALS_EXP_AWAY']).drop_duplicates('SRC_EVENT_ID').set_index('SRC_EVENT_ID')
+    fav_is_home = (goals_base['GOALS_EXP_HOME'] > goals_base['GOALS_EXP_AWAY']).rename('FAV_IS_HOME')
+    return df.join(fav_is_home.astype('boolean'), on='SRC_EVENT_ID')
+
+def apply_filters(df, date_range):
+    mask = np.ones(len(df), dtype=bool)
+    if len(date_range) == 2 and 'EVENT_START_TIMESTAMP' in df.columns:
+        start = pd.Timestamp(date_range[0])
+        end = pd.Timestamp(date_range[1]) + pd.Timedelta(days=1)
+        mask &= ((df['EVENT_START_TIMESTAMP'] >= start) & (df['EVENT_START_TIMESTAMP'] < end)).to_numpy()
+    return df if mask.all() else df.loc[mask]
+
+@st.cache_data(show_spinner=False)
 def compute_exp_change(df, exp_type):
     incident = "Goals" if "Goals" in exp_type else ("Corners" if "Corners" in exp_type else "Yellow")
     home_col = f"{incident.upper()}_EXP_HOME"
     away_col = f"{incident.upper()}_EXP_AWAY"
 
-    df_filtered = df.dropna(subset=[home_col, away_col, 'MINUTES'])
-
-    df_sorted = df_filtered.sort_values(['SRC_EVENT_ID', 'MINUTES'])
-    base_exp = df_sorted.groupby('SRC_EVENT_ID').first().reset_index()
-
-    base_exp['FAVOURITE'] = np.where(base_exp[home_col] > base_exp[away_col], 'Home', 'Away')
-    df_merged = df_sorted.merge(base_exp[['SRC_EVENT_ID', 'FAVOURITE', home_col, away_col]], on='SRC_EVENT_ID', suffixes=('', '_BASE'))
-
-    rows = []
-    for _, row in df_merged.iterrows():
-        fav = row['FAVOURITE']
-        base_home = row[f'{home_col}_BASE']
-        base_away = row[f'{away_col}_BASE']
-
-        if "Favourite" in exp_type:
-            col = home_col if fav == 'Home' else away_col
-            base = base_home if fav == 'Home' else base_away
-            row_val = row[col]
-        elif "Underdog" in exp_type:
-            col = away_col if fav == 'Home' else home_col
-            base = base_away if fav == 'Home' else base_home
-            row_val = row[col]
-        else:  # Total
-            home_val = row[home_col]
-            away_val = row[away_col]
-            row_val = home_val + away_val if pd.notna(home_val) and pd.notna(away_val) else np.nan
-            base = base_home + base_away if pd.notna(base_home) and pd.notna(base_away) else np.nan
-
-        if pd.isna(row_val) or pd.isna(base):
-            change = np.nan
-        else:
-            change = row_val - base
-
-        rows.append({
-            'SRC_EVENT_ID': row['SRC_EVENT_ID'],
-            'Time Band': f"{int(row['MINUTES']//5)*5}-{int(row['MINUTES']//5)*5 + 5}",
-            'Change': change
-        })
-
-    return pd.DataFrame(rows)
+    required_cols = [home_col, away_col, 'MINUTES'] + (['FAV_IS_HOME'] if "Total" not in exp_type else [])
+    df_filtered = df[['SRC_EVENT_ID', 'MINUTES', 'FAV_IS_HOME', home_col, away_col]].dropna(subset=required_cols)
+
+    # df is sorted by sort_by_event, so the first row left per event is its baseline
+    base_exp = df_filtered.drop_duplicates('SRC_EVENT_ID').set_index('SRC_EVENT_ID')[[home_col, away_col]]
+    df_merged = df_filtered.join(base_exp.add_suffix('_BASE'), on='SRC_EVENT_ID')
+    base_home = df_merged[f'{home_col}_BASE'].to_numpy()
+    base_away = df_merged[f'{away_col}_BASE'].to_numpy()
+    home_vals = df_merged[home_col].to_numpy()
+    away_vals = df_merged[away_col].to_numpy()
+    fav_is_home = df_merged['FAV_IS_HOME'].to_numpy(dtype=bool, na_value=False)
+
+    # numexpr evaluates each expression in one fused pass without temporaries
+    if "Favourite" in exp_type:
+        change = ne.evaluate("where(fav_is_home, home_vals - base_home, away_vals - base_away)")
+    elif "Underdog" in exp_type:
+        change = ne.evaluate("where(fav_is_home, away_vals - base_away, home_vals - base_home)")
+    else:  # Total
+        change = ne.evaluate("home_vals + away_vals - (base_home + base_away)")
+
+    # 18 bands cover 0-90; stoppage time adds bands beyond that
+    band_codes = (df_merged['MINUTES'].to_numpy() // 5).astype(np.int8)
+    n_bands = max(18, band_codes.max(initial=-1) + 1)
+    time_bands = pd.Categorical.from_codes(band_codes, categories=[f"{i}-{i + 5}" for i in range(0, n_bands * 5, 5)])
+
+    # Only the per-band mean is charted, so reduce here instead of returning every row;
+    # observed=False keeps empty bands as NaN so each chart gets the full band axis
+    change = pd.Series(change, index=df_merged.index, name='Change')
+    return change.groupby(time_bands, observed=False).mean().rename_axis('Time Band')
 
 # ---------------------- PLOTTING ----------------------
-def plot_exp_change(df_changes, title):
-    avg_change = df_changes.groupby('Time Band')['Change'].mean()
-    fig, ax = plt.subplots(figsize=(6, 4))
-    avg_change.plot(marker='o', ax=ax)
-    ax.set_ylabel("Avg Change")
-    ax.set_xlabel("Time Band (Minutes)")
-    ax.set_title(f"{title} Expectancy Change")
-    ax.grid(True)
+def plot_exp_changes(exp_types, avg_changes):
+    # All charts share one figure, laid out three per row; each session keeps the
+    # figure for its current selection and only swaps line data on reruns. The
+    # figure bypasses pyplot's global registry, so dropping it from session state frees it
+    chart = st.session_state.get('chart')
+    if chart is None or chart[0] != exp_types:
+        n_cols = min(3, len(exp_types))
+        n_rows = -(-len(exp_types) // n_cols)
+        fig = Figure(figsize=(6 * n_cols, 4 * n_rows), layout="constrained")
+        axes = fig.subplots(n_rows, n_cols, squeeze=False)
+        lines = []
+        for ax, title in zip(axes.flat, exp_types):
+            line, = ax.plot([], [], marker='o')
+            ax.set_ylabel("Avg Change")
+            ax.set_xlabel("Time Band (Minutes)")
+            ax.set_title(f"{title} Expectancy Change")
+            ax.grid(True)
+            lines.append(line)
+        for ax in axes.flat[len(exp_types):]:
+            ax.set_visible(False)
+        chart = st.session_state['chart'] = (exp_types, fig, lines)
+    _, fig, lines = chart
+    for line, avg_change in zip(lines, avg_changes):
+        ax = line.axes
+        positions = np.arange(len(avg_change))
+        line.set_data(positions, avg_change.to_numpy())
+        ax.set_xticks(positions, avg_change.index.astype(str), rotation=45, fontsize=8)
+        ax.relim()
+        ax.autoscale_view()
     return fig
 
 # ---------------------- MAIN APP ----------------------
 if exp_selected:
-    layout_cols = st.columns(min(3, len(exp_selected)))
-    plots = []
-    for i, exp in enumerate(exp_selected):
-        df_change = compute_exp_change(df, exp)
-        fig = plot_exp_change(df_change, exp)
-        with layout_cols[i % len(layout_cols)]:
-            st.pyplot(fig, use_container_width=True)
-        plots.append(fig)
+    # Filter before computing so baselines and bands only cover the selected matches
+    df_filtered = apply_filters(flag_favourites(sort_by_event(df)), date_range)
+    # Types are independent and pandas releases the GIL in its kernels, so compute
+    # them on worker threads; plotting stays on this thread as matplotlib isn't thread-safe
+    with st.spinner("⚙️ Computing expectancy changes..."):
+        with ThreadPoolExecutor(max_workers=len(exp_selected), initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())) as executor:
+            changes = list(executor.map(lambda exp: compute_exp_change(df_filtered, exp), exp_selected))
+    fig = plot_exp_changes(tuple(exp_selected), changes)
+    st.pyplot(fig, use_container_width=True)
 
     # PDF Export
     if st.button("📥 Download All Charts as PDF"):
-        pdf = FPDF()
-        for fig in plots:
-            with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as tmpfile:
-                fig.savefig(tmpfile.name)
-                pdf.add_page()
-                pdf.image(tmpfile.name, x=10, y=10, w=180)
-                os.unlink(tmpfile.name)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as f:
-            pdf.output(f.name)
-            with open(f.name, "rb") as f_pdf:
-                st.download_button("📄 Download PDF", f_pdf.read(), "expectancy_charts.pdf")
+        # Matplotlib's PDF backend writes the charts as vector graphics directly
+        pdf = BytesIO()
+        fig.savefig(pdf, format="pdf")
+        st.download_button("📄 Download PDF", pdf.getvalue(), "expectancy_charts.pdf")
 else:
     st.warning("Please select at least one expectancy type to display charts.")
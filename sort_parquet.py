@@ -0,0 +1,13 @@
+import sys
+import pyarrow.parquet as pq
+
+# One-off preprocessing: rewrite the source Parquet ordered by event and minute
+# so sort_by_event in "Parquet Afternoon.py" can skip its runtime sort.
+# Usage: python sort_parquet.py <input.parquet> <output.parquet>
+SORT_KEYS = [('SRC_EVENT_ID', 'ascending'), ('MINUTES', 'ascending')]
+
+if __name__ == "__main__":
+    src_path, dst_path = sys.argv[1], sys.argv[2]
+    table = pq.read_table(src_path)
+    pq.write_table(table.sort_by(SORT_KEYS), dst_path, row_group_size=500_000)
+    print(f"✅ Wrote {table.num_rows:,} sorted rows to {dst_path}")